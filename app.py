@@ -1,8 +1,14 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort
 from datetime import datetime, timedelta
-import json, pytz, os, re, uuid
-from matrixCalculator import compute_matrix
+import json, pytz, os, re, uuid, threading
+from matrixCalculator import compute_matrix, compute_matrices_batch, compact_matrix, get_cached_station_count, configure_upstream, configure_fare_table
 from request_queue import RequestQueue
+from scheduler import create_policy
+from congestion import AIMDController
+from fare_table import FareTable
+from page_cache import RenderedPageCache
+from profiler import SamplingProfiler
+import tracing
 
 app = Flask(__name__)
 app.secret_key = "super_secret_key"
@@ -17,27 +23,99 @@ with open('static/js/script.js', 'r', encoding='utf-8') as js_file:
 with open('static/css/styles.css', 'r', encoding='utf-8') as css_file:
     STYLES_CSS_CONTENT = css_file.read()
 
+def configure_upstream_controller():
+    controller = AIMDController(
+        initial_limit=CONFIG.get("upstream_initial_concurrency", 4),
+        min_limit=CONFIG.get("upstream_min_concurrency", 1),
+        max_limit=CONFIG.get("upstream_max_concurrency", 32),
+        decrease_factor=CONFIG.get("upstream_decrease_factor", 0.5),
+        latency_threshold=CONFIG.get("upstream_latency_threshold", 3.0),
+        recovery_period=CONFIG.get("upstream_recovery_period", 5.0)
+    )
+    configure_upstream(controller, timeout=CONFIG.get("upstream_timeout", 15))
+    return controller
+
+upstream_controller = configure_upstream_controller()
+
+fare_table = FareTable(
+    path=CONFIG.get("fare_table_path", "fare_table.json"),
+    validation_interval=CONFIG.get("fare_validation_interval", 86400)
+)
+configure_fare_table(fare_table)
+
 def configure_request_queue():
     max_concurrent = CONFIG.get("queue_max_concurrent", 1)
     cooldown_period = CONFIG.get("queue_cooldown_period", 3)
     batch_cleanup_threshold = CONFIG.get("queue_batch_cleanup_threshold", 10)
     cleanup_interval = CONFIG.get("queue_cleanup_interval", 30)
     heartbeat_timeout = CONFIG.get("queue_heartbeat_timeout", 90)
+    state_shards = CONFIG.get("queue_state_shards", 16)
+    result_ttl = CONFIG.get("queue_result_ttl", 1800)
+    
+    policy_name = CONFIG.get("queue_scheduling_policy", "fair_sjf")
+    policy_options = {}
+    if policy_name == "fair_sjf":
+        policy_options = {
+            "aging_rate": CONFIG.get("queue_aging_rate", 0.5),
+            "client_penalty": CONFIG.get("queue_client_penalty", 1.0),
+            "client_weights": CONFIG.get("queue_client_weights", {})
+        }
     
     return RequestQueue(
         max_concurrent=max_concurrent, 
         cooldown_period=cooldown_period,
         batch_cleanup_threshold=batch_cleanup_threshold,
         cleanup_interval=cleanup_interval,
-        heartbeat_timeout=heartbeat_timeout
+        heartbeat_timeout=heartbeat_timeout,
+        scheduling_policy=create_policy(policy_name, **policy_options),
+        congestion_controller=upstream_controller,
+        state_shards=state_shards,
+        result_ttl=result_ttl
     )
 
 request_queue = configure_request_queue()
 
+result_page_cache = RenderedPageCache(
+    max_entries=CONFIG.get("result_page_cache_size", 200),
+    ttl=CONFIG.get("queue_result_ttl", 1800)
+)
+
+tracing.trace_store.max_traces = CONFIG.get("tracing_max_traces", 50)
+tracing.trace_store.max_spans = CONFIG.get("tracing_max_spans", 500)
+
+def worker_threads():
+    threads = [("worker", request_queue.worker_thread.ident)]
+    threads.extend(("fetch", t.ident) for t in threading.enumerate() if t.name.startswith("matrix-fetch"))
+    return threads
+
+profiler = SamplingProfiler(worker_threads, interval=CONFIG.get("profiler_interval", 0.01))
+if CONFIG.get("profiler_enabled", False):
+    profiler.start()
+
 with open('trains_en.json', 'r') as f:
     trains_data = json.load(f)
     trains = trains_data['trains']
 
+def get_client_id():
+    # Only entries appended by our own proxies can be trusted; anything to
+    # their left is supplied by the client.
+    trusted_hops = CONFIG.get("trusted_proxy_hops", 1)
+    forwarded_for = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+    if trusted_hops > 0 and len(forwarded_for) >= trusted_hops:
+        return forwarded_for[-trusted_hops]
+    return request.remote_addr
+
+def parse_train_model(train_model_full):
+    model_match = re.match(r'.*\((\d+)\)$', train_model_full)
+    if model_match:
+        return model_match.group(1)
+    return train_model_full.split('(')[0].strip()
+
+def start_trace():
+    if not CONFIG.get("tracing_enabled", False):
+        return None
+    return tracing.trace_store.start().trace_id
+
 def check_maintenance():
     if CONFIG.get("is_maintenance", 0):
         return render_template(
@@ -55,6 +133,8 @@ def block_cloudflare_noise():
 
 @app.after_request
 def set_cache_headers(response):
+    if getattr(response, 'revalidated_page', False):
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -123,11 +203,7 @@ def matrix():
         session['error'] = "Invalid date format. Use DD-MMM-YYYY (e.g. 15-Nov-2024)."
         return redirect(url_for('home'))
 
-    model_match = re.match(r'.*\((\d+)\)$', train_model_full)
-    if model_match:
-        train_model = model_match.group(1)
-    else:
-        train_model = train_model_full.split('(')[0].strip()
+    train_model = parse_train_model(train_model_full)
 
     try:
         form_values = {
@@ -137,6 +213,7 @@ def matrix():
         session['form_values'] = form_values
         session['form_submitted'] = True
 
+        trace_id = start_trace()
         request_id = request_queue.add_request(
             process_matrix_request,
             {
@@ -144,12 +221,18 @@ def matrix():
                 'journey_date_str': journey_date_str,
                 'api_date_format': api_date_format,
                 'form_values': form_values
-            }
+            },
+            client_id=get_client_id(),
+            station_count=get_cached_station_count(train_model),
+            trace_id=trace_id
         )
         
         session['queue_request_id'] = request_id
         
-        return redirect(url_for('queue_wait'))
+        response = redirect(url_for('queue_wait'))
+        if trace_id:
+            response.headers['X-Trace-Id'] = trace_id
+        return response
     except Exception as e:
         session['error'] = f"{str(e)}"
         return redirect(url_for('home'))
@@ -160,7 +243,7 @@ def process_matrix_request(train_model, journey_date_str, api_date_format, form_
         if not result or 'stations' not in result:
             return {"error": "No data received. Please try a different train or date."}
         
-        return {"success": True, "result": result, "form_values": form_values}
+        return {"success": True, "result": result, "form_values": form_values, "trace_id": tracing.current_trace_id()}
     except Exception as e:
         return {"error": str(e)}
 
@@ -260,6 +343,12 @@ def show_results_with_id(request_id):
     if maintenance_response:
         return maintenance_response
 
+    page = result_page_cache.get(request_id)
+    if page:
+        if session.get('queue_request_id') == request_id:
+            session.pop('queue_request_id', None)
+        return serve_cached_page(page)
+
     queue_result = request_queue.get_request_result(request_id)
     
     if not queue_result:
@@ -280,13 +369,33 @@ def show_results_with_id(request_id):
     if session.get('queue_request_id') == request_id:
         session.pop('queue_request_id', None)
     
-    return render_template(
-        'matrix.html',
-        **result,
-        form_values=form_values,
-        styles_css=STYLES_CSS_CONTENT,
-        script_js=SCRIPT_JS_CONTENT
-    )
+    with tracing.activate(tracing.trace_store.get(queue_result.get("trace_id"))):
+        with tracing.span("render"):
+            html = render_template(
+                'matrix.html',
+                **result,
+                form_values=form_values,
+                styles_css=STYLES_CSS_CONTENT,
+                script_js=SCRIPT_JS_CONTENT
+            )
+        with tracing.span("compress", size=len(html)):
+            page = result_page_cache.put(request_id, html)
+    return serve_cached_page(page)
+
+def serve_cached_page(page):
+    # The same ETag covers every encoding of the page, so it is weak.
+    if request.if_none_match.contains_weak(page.etag):
+        response = app.response_class(status=304)
+    else:
+        body, encoding = page.body_for(request.accept_encodings)
+        response = app.response_class(body, mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(page.etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.revalidated_page = True
+    return response
 
 @app.route('/matrix_result')
 def matrix_result():
@@ -313,6 +422,8 @@ def matrix_result():
 def queue_stats():
     try:
         stats = request_queue.get_queue_stats()
+        stats["result_pages"] = result_page_cache.get_stats()
+        stats["fare_table"] = fare_table.get_stats()
         return jsonify(stats)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -326,6 +437,99 @@ def queue_cleanup():
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)}), 500
 
+@app.route('/api/matrix/batch', methods=['POST'])
+def api_matrix_batch():
+    if CONFIG.get("is_maintenance", 0):
+        return jsonify({"error": CONFIG.get("maintenance_message", "")}), 503
+
+    payload = request.get_json(silent=True)
+    items = payload.get("trains") if isinstance(payload, dict) else None
+    max_trains = CONFIG.get("api_batch_max_trains", 10)
+
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "Provide a non-empty 'trains' list of {train_model, date} objects."}), 400
+    if len(items) > max_trains:
+        return jsonify({"error": f"At most {max_trains} trains can be requested at once."}), 400
+
+    train_requests = []
+    for item in items:
+        train_model_full = str(item.get("train_model", "")).strip()
+        journey_date_str = str(item.get("date", "")).strip()
+        if not train_model_full or not journey_date_str:
+            return jsonify({"error": "Each train needs both 'train_model' and 'date'."}), 400
+        try:
+            api_date_format = datetime.strptime(journey_date_str, '%d-%b-%Y').strftime('%Y-%m-%d')
+        except ValueError:
+            return jsonify({"error": f"Invalid date '{journey_date_str}'. Use DD-MMM-YYYY (e.g. 15-Nov-2024)."}), 400
+        train_requests.append((parse_train_model(train_model_full), journey_date_str, api_date_format))
+
+    train_requests = list(dict.fromkeys(train_requests))
+    trace_id = start_trace()
+    job_id = request_queue.add_request(
+        process_batch_request,
+        {'train_requests': train_requests},
+        client_id=get_client_id(),
+        station_count=[get_cached_station_count(train_model) for train_model, _, _ in train_requests],
+        trace_id=trace_id
+    )
+
+    return jsonify({
+        "job_id": job_id,
+        "trace_id": trace_id,
+        "status_url": url_for('api_matrix_batch_status', job_id=job_id)
+    }), 202
+
+def process_batch_request(train_requests):
+    return {"success": True, "trains": [compact_matrix(result) for result in compute_matrices_batch(train_requests)]}
+
+@app.route('/api/matrix/batch/<job_id>')
+def api_matrix_batch_status(job_id):
+    # Polling doubles as the heartbeat that keeps a queued job alive.
+    request_queue.update_heartbeat(job_id)
+    status = request_queue.get_request_status(job_id)
+    if not status:
+        return jsonify({"error": "Job not found or already collected"}), 404
+
+    if status["status"] in ("queued", "processing"):
+        return jsonify({
+            "job_id": job_id,
+            "status": status["status"],
+            "position": status["position"],
+            "estimated_time": status["estimated_time"]
+        }), 202
+
+    result = request_queue.get_request_result(job_id) or {}
+    if "error" in result:
+        return jsonify({"job_id": job_id, "status": "failed", "error": result["error"]}), 500
+    return jsonify({"job_id": job_id, "status": "completed", "trains": result.get("trains", [])})
+
+@app.route('/api/fares/<train_model>')
+def api_fares(train_model):
+    fares = fare_table.fare_matrices(parse_train_model(train_model))
+    if not fares:
+        return jsonify({"error": "No fares recorded for this train yet"}), 404
+    return jsonify(fares)
+
+@app.route('/debug/trace/<trace_id>')
+def debug_trace(trace_id):
+    if not CONFIG.get("debug_endpoints_enabled", False):
+        abort(404)
+    trace = tracing.trace_store.get(trace_id)
+    if not trace:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace.summary())
+
+@app.route('/debug/profile')
+def debug_profile():
+    if not CONFIG.get("debug_endpoints_enabled", False):
+        abort(404)
+    if request.args.get('format') == 'stats':
+        return jsonify(profiler.get_stats())
+    stacks = profiler.dump()
+    if request.args.get('reset') == '1':
+        profiler.reset()
+    return app.response_class(stacks, mimetype='text/plain')
+
 @app.errorhandler(404)
 def page_not_found(e):
     maintenance_response = check_maintenance()
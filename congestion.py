@@ -0,0 +1,107 @@
+import threading, time, random
+from collections import deque
+
+class UpstreamCongested(Exception):
+    pass
+
+class AIMDController:
+    # Additive-increase / multiplicative-decrease limit on in-flight upstream
+    # calls. Every clean response grows the window by roughly one slot per
+    # window's worth of responses; a 403/429, a timeout or a latency spike
+    # shrinks it by decrease_factor, at most once per recovery_period so a
+    # burst of failures from the same window only counts once.
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32, increase_step=1.0,
+                 decrease_factor=0.5, latency_threshold=3.0, recovery_period=5.0):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_threshold = latency_threshold
+        self.recovery_period = recovery_period
+
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.backoff_until = 0.0
+        self.latency_history = deque(maxlen=100)
+        self.counters = {"ok": 0, "congested": 0, "slow": 0, "error": 0, "decreases": 0}
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit) or time.time() < self.backoff_until:
+                wait = self.backoff_until - time.time()
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+        return time.time()
+
+    def release(self, started_at, outcome="ok"):
+        now = time.time()
+        latency = now - started_at
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.latency_history.append(latency)
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                else:
+                    self.baseline_latency += 0.05 * (min(latency, self.baseline_latency * 2) - self.baseline_latency)
+                if latency > self.baseline_latency * self.latency_threshold:
+                    self.counters["slow"] += 1
+                    self._decrease(now, backoff=False)
+                else:
+                    self.counters["ok"] += 1
+                    self.limit = min(self.max_limit, self.limit + self.increase_step / self.limit)
+            elif outcome == "congested":
+                self.counters["congested"] += 1
+                self._decrease(now, backoff=True)
+            else:
+                self.counters["error"] += 1
+            self.condition.notify_all()
+
+    def _decrease(self, now, backoff):
+        if now - self.last_decrease < self.recovery_period:
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self.last_decrease = now
+        self.counters["decreases"] += 1
+        if backoff:
+            self.backoff_until = now + self.recovery_period * (1 + random.random())
+
+    def call(self, func, *args, **kwargs):
+        started_at = self.acquire()
+        outcome = "error"
+        try:
+            result = func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except UpstreamCongested:
+            outcome = "congested"
+            raise
+        finally:
+            self.release(started_at, outcome)
+
+    def backoff_remaining(self):
+        return max(0.0, self.backoff_until - time.time())
+
+    def pacing_delay(self, base_delay):
+        # Space out whole jobs in proportion to how far the window has shrunk
+        # below (or grown above) its starting point.
+        return max(self.backoff_remaining(), base_delay * self.initial_limit / max(self.limit, self.min_limit))
+
+    def retry_delay(self, attempt):
+        return max(self.backoff_remaining(), self.recovery_period) + attempt * 2 + random.random() * 2
+
+    def get_stats(self):
+        with self.condition:
+            latencies = sorted(self.latency_history)
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "baseline_latency": round(self.baseline_latency, 3) if self.baseline_latency else None,
+                "p90_latency": round(latencies[int(len(latencies) * 0.9)], 3) if latencies else None,
+                "backoff_remaining": round(self.backoff_remaining(), 2),
+                **self.counters
+            }
@@ -0,0 +1,48 @@
+import heapq, itertools, threading, time
+from collections import Counter
+
+class DeadlineQueue:
+    # Min-heap of (deadline, kind, key). Entries are never updated in place:
+    # whoever pops a due entry checks the live state and either acts on it,
+    # drops it, or schedules a fresh deadline. Heartbeats therefore cost
+    # nothing here, and a sweep only touches entries whose deadline passed.
+    def __init__(self):
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.expired = Counter()
+        self.rescheduled = Counter()
+
+    def schedule(self, deadline, kind, key):
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, next(self.counter), kind, key))
+
+    def reschedule(self, deadline, kind, key):
+        self.rescheduled[kind] += 1
+        self.schedule(deadline, kind, key)
+
+    def pop_due(self, now=None):
+        now = now or time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, kind, key = heapq.heappop(self.heap)
+                due.append((kind, key))
+        return due
+
+    def record_expired(self, kind, count=1):
+        self.expired[kind] += count
+
+    def next_deadline(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def get_stats(self):
+        return {
+            "pending": len(self.heap),
+            "expired": dict(self.expired),
+            "rescheduled": dict(self.rescheduled)
+        }
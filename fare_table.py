@@ -0,0 +1,96 @@
+import json, os, threading, time
+
+class FareTable:
+    # Fares per train model, segment and seat class. A segment is filled in
+    # the first time the train is seen on it and re-read from the upstream
+    # response only once its validation interval has passed, so regular
+    # lookups only need seat counts.
+    def __init__(self, path=None, validation_interval=86400):
+        self.path = path
+        self.validation_interval = validation_interval
+        self.trains = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.changes = 0
+        self.load()
+
+    @staticmethod
+    def _segment_key(from_city, to_city):
+        return f"{from_city}|{to_city}"
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.trains = json.load(f).get("trains", {})
+        except (OSError, ValueError) as e:
+            print(f"Fare table: could not load {self.path}: {e}")
+
+    def save_if_dirty(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = json.dumps({"version": 1, "trains": self.trains}, separators=(',', ':'))
+            self.dirty = False
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            self.dirty = True
+            print(f"Fare table: could not save {self.path}: {e}")
+
+    def set_stations(self, train_model, stations):
+        with self.lock:
+            train = self.trains.setdefault(train_model, {"stations": [], "segments": {}})
+            if train["stations"] != stations:
+                train["stations"] = list(stations)
+                self.dirty = True
+
+    def needs_fares(self, train_model, from_city, to_city, seat_types):
+        with self.lock:
+            segment = self.trains.get(train_model, {}).get("segments", {}).get(self._segment_key(from_city, to_city))
+            if not segment or time.time() - segment["validated_at"] > self.validation_interval:
+                return True
+            return any(seat_type not in segment["fares"] for seat_type in seat_types)
+
+    def record(self, train_model, from_city, to_city, fares):
+        with self.lock:
+            train = self.trains.setdefault(train_model, {"stations": [], "segments": {}})
+            segment = train["segments"].setdefault(
+                self._segment_key(from_city, to_city), {"validated_at": 0, "fares": {}}
+            )
+            for seat_type, fare in fares.items():
+                if segment["fares"].get(seat_type) != fare:
+                    if seat_type in segment["fares"]:
+                        self.changes += 1
+                    segment["fares"][seat_type] = fare
+            segment["validated_at"] = time.time()
+            self.dirty = True
+
+    def lookup(self, train_model, from_city, to_city, seat_type):
+        with self.lock:
+            segment = self.trains.get(train_model, {}).get("segments", {}).get(self._segment_key(from_city, to_city))
+            return segment["fares"].get(seat_type) if segment else None
+
+    def fare_matrices(self, train_model):
+        with self.lock:
+            train = self.trains.get(train_model)
+            if not train:
+                return None
+            fares = {}
+            for key, segment in train["segments"].items():
+                from_city, to_city = key.split("|", 1)
+                for seat_type, fare in segment["fares"].items():
+                    fares.setdefault(seat_type, {}).setdefault(from_city, {})[to_city] = fare
+            return {"train_model": train_model, "stations": train["stations"], "fares": fares}
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "trains": len(self.trains),
+                "segments": sum(len(train["segments"]) for train in self.trains.values()),
+                "changes": self.changes
+            }
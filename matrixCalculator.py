@@ -1,12 +1,60 @@
-import requests
+import requests, threading, time
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from congestion import AIMDController, UpstreamCongested
+from fare_table import FareTable
+import tracing
 
 SEAT_TYPES = [
     "S_CHAIR", "SHOVAN", "SNIGDHA", "F_SEAT", "F_CHAIR", "AC_S", "F_BERTH", "AC_B", "SHULOV", "AC_CHAIR"
 ]
 
+TRAIN_STATION_COUNTS = {}
+
+PAIR_OK = "ok"
+PAIR_EMPTY = "empty"
+PAIR_FAILED = "failed"
+PAIR_STALE = "stale"
+
+PAIR_RETRY_ROUNDS = 2
+LAST_KNOWN_GOOD_MAX_AGE = 1800
+LAST_KNOWN_GOOD_MAX_ENTRIES = 20000
+LAST_KNOWN_GOOD = OrderedDict()
+last_known_good_lock = threading.Lock()
+
+UPSTREAM_TIMEOUT = 15
+upstream_controller = AIMDController()
+fare_table = FareTable()
+
+def configure_upstream(controller: AIMDController, timeout: float = UPSTREAM_TIMEOUT) -> None:
+    global upstream_controller, UPSTREAM_TIMEOUT
+    upstream_controller = controller
+    UPSTREAM_TIMEOUT = timeout
+
+def configure_fare_table(table: FareTable) -> None:
+    global fare_table
+    fare_table = table
+
+def _upstream_request(method: str, url: str, span_attrs: dict = None, **kwargs) -> requests.Response:
+    started_at = time.time()
+    if span_attrs is not None:
+        span_attrs["slot_wait"] = round(started_at - span_attrs.pop("submitted_at", started_at), 4)
+    try:
+        response = requests.request(method, url, timeout=UPSTREAM_TIMEOUT, **kwargs)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        raise UpstreamCongested(f"Upstream timeout: {e}")
+    if span_attrs is not None:
+        span_attrs["http_status"] = response.status_code
+    if response.status_code in (403, 429):
+        raise UpstreamCongested(f"Rate limit exceeded (HTTP {response.status_code})")
+    response.raise_for_status()
+    return response
+
+def _traced_upstream(name: str, attrs: dict, method: str, url: str, **kwargs) -> requests.Response:
+    with tracing.span(name, submitted_at=time.time(), **attrs) as attrs:
+        return upstream_controller.call(_upstream_request, method, url, span_attrs=attrs, **kwargs)
+
 def fetch_train_data(model: str, api_date: str) -> dict:
     url = "https://railspaapi.shohoz.com/v1.0/web/train-routes"
     payload = {
@@ -15,11 +63,34 @@ def fetch_train_data(model: str, api_date: str) -> dict:
     }
     headers = {'Content-Type': 'application/json'}
 
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json().get("data")
+    response = _traced_upstream("fetch_train_data", {"model": model}, "POST", url, json=payload, headers=headers)
+    data = response.json().get("data")
+    if data and data.get("routes"):
+        TRAIN_STATION_COUNTS[model] = len(data["routes"])
+    return data
+
+def get_cached_station_count(model: str):
+    return TRAIN_STATION_COUNTS.get(model)
+
+def _remember_pair(key: tuple, seat_info) -> None:
+    with last_known_good_lock:
+        LAST_KNOWN_GOOD[key] = (seat_info, time.time())
+        LAST_KNOWN_GOOD.move_to_end(key)
+        while len(LAST_KNOWN_GOOD) > LAST_KNOWN_GOOD_MAX_ENTRIES:
+            LAST_KNOWN_GOOD.popitem(last=False)
+
+def _forget_pair(key: tuple) -> None:
+    with last_known_good_lock:
+        LAST_KNOWN_GOOD.pop(key, None)
 
-def get_seat_availability(train_model: str, journey_date: str, from_city: str, to_city: str) -> tuple:
+def _recall_pair(key: tuple):
+    with last_known_good_lock:
+        cached = LAST_KNOWN_GOOD.get(key)
+    if cached and time.time() - cached[1] <= LAST_KNOWN_GOOD_MAX_AGE:
+        return cached
+    return None
+
+def search_trips(from_city: str, to_city: str, journey_date: str) -> tuple:
     url = "https://railspaapi.shohoz.com/v1.0/web/bookings/search-trips-v2"
     params = {
         "from_city": from_city,
@@ -29,34 +100,47 @@ def get_seat_availability(train_model: str, journey_date: str, from_city: str, t
     }
 
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
+        response = _traced_upstream("search_trips", {"route": f"{from_city}-{to_city}"}, "GET", url, params=params)
         trains = response.json().get("data", {}).get("trains", [])
+        return (from_city, to_city, journey_date, trains, PAIR_OK)
+    except (requests.RequestException, UpstreamCongested, ValueError):
+        return (from_city, to_city, journey_date, None, PAIR_FAILED)
 
-        for train in trains:
-            if train.get("train_model") == train_model:
-                seat_info = {stype: {"online": 0, "offline": 0, "fare": 0, "vat_amount": 0} for stype in SEAT_TYPES}
-                for seat in train.get("seat_types", []):
-                    stype = seat["type"]
-                    if stype in seat_info:
-                        fare = float(seat["fare"])
-                        vat_amount = float(seat["vat_amount"])
-                        if stype in ["AC_B", "F_BERTH"]:
-                            fare += 50
-                        seat_info[stype] = {
-                            "online": seat["seat_counts"]["online"],
-                            "offline": seat["seat_counts"]["offline"],
-                            "fare": fare,
-                            "vat_amount": vat_amount
-                        }
-                return (from_city, to_city, seat_info)
-
-        return (from_city, to_city, None)
-
-    except requests.RequestException:
-        return (from_city, to_city, None)
+def find_train(trains: list, train_model: str):
+    for train in trains:
+        if train.get("train_model") == train_model:
+            return train
+    return None
 
-def compute_matrix(train_model: str, journey_date_str: str, api_date_format: str) -> dict:
+def parse_seat_counts(train: dict) -> dict:
+    seat_info = {stype: {"online": 0, "offline": 0} for stype in SEAT_TYPES}
+    for seat in train.get("seat_types", []):
+        stype = seat["type"]
+        if stype in seat_info:
+            seat_info[stype] = {
+                "online": seat["seat_counts"]["online"],
+                "offline": seat["seat_counts"]["offline"]
+            }
+    return seat_info
+
+def parse_seat_fares(train: dict) -> dict:
+    fares = {}
+    for seat in train.get("seat_types", []):
+        stype = seat["type"]
+        if stype in SEAT_TYPES:
+            fare = float(seat["fare"])
+            vat_amount = float(seat["vat_amount"])
+            if stype in ["AC_B", "F_BERTH"]:
+                fare += 50
+            fares[stype] = [fare, vat_amount]
+    return fares
+
+def observe_fares(train_model: str, from_city: str, to_city: str, train: dict) -> None:
+    offered = [seat["type"] for seat in train.get("seat_types", []) if seat.get("type") in SEAT_TYPES]
+    if fare_table.needs_fares(train_model, from_city, to_city, offered):
+        fare_table.record(train_model, from_city, to_city, parse_seat_fares(train))
+
+def prepare_train(train_model: str, journey_date_str: str, api_date_format: str) -> dict:
     train_data = fetch_train_data(train_model, api_date_format)
     if not train_data or not train_data.get("train_name") or not train_data.get("routes"):
         raise Exception("No information found for this train. Please try another train or date.")
@@ -117,39 +201,122 @@ def compute_matrix(train_model: str, journey_date_str: str, api_date_format: str
     # if weekday_short not in days:
     #     raise Exception(f"{train_name} does not run on {weekday_full}.")
 
+    return {
+        "train_model": train_model,
+        "train_name": train_name,
+        "date": journey_date_str,
+        "stations": stations,
+        "routes": routes,
+        "days": days,
+        "total_duration": total_duration,
+        "station_dates": station_dates,
+    }
+
+def trip_lookups(prepared: dict) -> list:
+    stations = prepared["stations"]
+    station_dates = prepared["station_dates"]
+    return [
+        (from_city, to_city, datetime.strptime(station_dates[from_city], "%Y-%m-%d").strftime("%d-%b-%Y"))
+        for i, from_city in enumerate(stations)
+        for j, to_city in enumerate(stations)
+        if i < j
+    ]
+
+def fetch_trips(lookups) -> dict:
+    pending = list(dict.fromkeys(lookups))
+    trip_results = {}
+
+    # Only lookups the upstream failed to answer are retried, in rounds spaced
+    # out by the congestion controller's backoff; the job itself never is.
+    with ThreadPoolExecutor(max_workers=upstream_controller.max_limit, thread_name_prefix="matrix-fetch") as executor:
+        for attempt in range(PAIR_RETRY_ROUNDS + 1):
+            if attempt:
+                with tracing.span("retry_backoff", attempt=attempt, pending=len(pending)):
+                    time.sleep(upstream_controller.retry_delay(attempt - 1))
+            traced_search = tracing.propagate(search_trips)
+            futures = [
+                executor.submit(traced_search, from_city, to_city, journey_date)
+                for from_city, to_city, journey_date in pending
+            ]
+            pending = []
+            for future in as_completed(futures):
+                from_city, to_city, journey_date, trains, status = future.result()
+                trip_results[(from_city, to_city, journey_date)] = (trains, status)
+                if status == PAIR_FAILED:
+                    pending.append((from_city, to_city, journey_date))
+            if not pending:
+                break
+
+    return trip_results
+
+def assemble_matrix(prepared: dict, trip_results: dict) -> dict:
+    train_model = prepared["train_model"]
+    journey_date_str = prepared["date"]
+    stations = prepared["stations"]
+    station_dates = prepared["station_dates"]
+
     fare_matrices = {
         seat_type: {from_city: {} for from_city in stations} for seat_type in SEAT_TYPES
     }
 
     seat_type_has_data = {seat_type: False for seat_type in SEAT_TYPES}
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [
-            executor.submit(
-                get_seat_availability,
-                train_model,
-                datetime.strptime(station_dates[from_city], "%Y-%m-%d").strftime("%d-%b-%Y"),
-                from_city,
-                to_city
-            )
-            for i, from_city in enumerate(stations)
-            for j, to_city in enumerate(stations)
-            if i < j
-        ]
-        for future in as_completed(futures):
-            from_city, to_city, seat_info = future.result()
-            for seat_type in SEAT_TYPES:
-                fare_matrices[seat_type][from_city][to_city] = (
-                    seat_info.get(seat_type, {"online": 0, "offline": 0, "fare": 0})
-                    if seat_info else {"online": 0, "offline": 0, "fare": 0}
-                )
-                if seat_info:
-                    for seat_type in SEAT_TYPES:
-                        if seat_info[seat_type]["online"] + seat_info[seat_type]["offline"] > 0:
-                            seat_type_has_data[seat_type] = True
+    pair_status_counts = {PAIR_OK: 0, PAIR_EMPTY: 0, PAIR_FAILED: 0, PAIR_STALE: 0}
+    for from_city, to_city, journey_date in trip_lookups(prepared):
+        trains, status = trip_results[(from_city, to_city, journey_date)]
+        seat_info = None
+        if status == PAIR_OK:
+            train = find_train(trains, train_model)
+            if train:
+                seat_info = parse_seat_counts(train)
+                observe_fares(train_model, from_city, to_city, train)
+            else:
+                status = PAIR_EMPTY
+
+        cache_key = (train_model, station_dates[from_city], from_city, to_city)
+        age = None
+        if status == PAIR_FAILED:
+            cached = _recall_pair(cache_key)
+            if cached:
+                seat_info, fetched_at = cached
+                status = PAIR_STALE
+                age = int(time.time() - fetched_at)
+        elif status == PAIR_OK:
+            _remember_pair(cache_key, seat_info)
+        else:
+            # A newer answer with no listing supersedes any earlier seat count.
+            _forget_pair(cache_key)
+        pair_status_counts[status] += 1
+
+        for seat_type in SEAT_TYPES:
+            cell = dict(seat_info[seat_type]) if seat_info else {"online": 0, "offline": 0}
+            cell["status"] = status
+            if age is not None:
+                cell["age"] = age
+            fare_matrices[seat_type][from_city][to_city] = cell
+            if cell["online"] + cell["offline"] > 0:
+                seat_type_has_data[seat_type] = True
 
     if not any(seat_type_has_data.values()):
+        if pair_status_counts[PAIR_FAILED]:
+            raise Exception("Bangladesh Railway is not responding for some stations right now. Please wait a minute before searching again.")
         raise Exception("No seats available for the selected train and date. Please try a different date or train.")
+
+    # Fares come from the fare table rather than each availability cell, and
+    # only for segments that currently have seats.
+    fare_table.set_stations(train_model, stations)
+    fares = {}
+    for seat_type in SEAT_TYPES:
+        if not seat_type_has_data[seat_type]:
+            continue
+        fares[seat_type] = {from_city: {} for from_city in stations}
+        for from_city, row in fare_matrices[seat_type].items():
+            for to_city, cell in row.items():
+                if cell["online"] + cell["offline"] > 0:
+                    fare = fare_table.lookup(train_model, from_city, to_city, seat_type)
+                    if fare:
+                        fares[seat_type][from_city][to_city] = fare
+    fare_table.save_if_dirty()
     
     station_dates_formatted = {
         station: datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%b-%Y")
@@ -169,18 +336,83 @@ def compute_matrix(train_model: str, journey_date_str: str, api_date_format: str
 
     return {
         "train_model": train_model,
-        "train_name": train_name,
+        "train_name": prepared["train_name"],
         "date": journey_date_str,
         "stations": stations,
         "seat_types": SEAT_TYPES,
         "fare_matrices": fare_matrices,
+        "fares": fares,
         "has_data_map": seat_type_has_data,
-        "routes": routes,
-        "days": days,
-        "total_duration": total_duration,
+        "pair_status_counts": pair_status_counts,
+        "routes": prepared["routes"],
+        "days": prepared["days"],
+        "total_duration": prepared["total_duration"],
         "station_dates": station_dates,
         "station_dates_formatted": station_dates_formatted,
         "has_segmented_dates": has_segmented_dates,
         "next_day_str": next_day_str,
         "prev_day_str": prev_day_str,
-    }
\ No newline at end of file
+    }
+
+def compute_matrix(train_model: str, journey_date_str: str, api_date_format: str) -> dict:
+    prepared = prepare_train(train_model, journey_date_str, api_date_format)
+    with tracing.span("fetch_trips", stations=len(prepared["stations"])):
+        trip_results = fetch_trips(trip_lookups(prepared))
+    with tracing.span("assemble_matrix"):
+        return assemble_matrix(prepared, trip_results)
+
+def compute_matrices_batch(train_requests: list) -> list:
+    # One search-trips response lists every train on that segment and date,
+    # so trains sharing a route are answered by the same upstream calls.
+    outcomes = []
+    for train_model, journey_date_str, api_date_format in train_requests:
+        try:
+            outcomes.append(prepare_train(train_model, journey_date_str, api_date_format))
+        except Exception as e:
+            outcomes.append({"train_model": train_model, "date": journey_date_str, "error": str(e)})
+
+    lookups = [lookup for prepared in outcomes if "error" not in prepared for lookup in trip_lookups(prepared)]
+    with tracing.span("fetch_trips", lookups=len(lookups)):
+        trip_results = fetch_trips(lookups)
+
+    results = []
+    for prepared in outcomes:
+        if "error" in prepared:
+            results.append(prepared)
+            continue
+        try:
+            results.append(assemble_matrix(prepared, trip_results))
+        except Exception as e:
+            results.append({"train_model": prepared["train_model"], "date": prepared["date"], "error": str(e)})
+    return results
+
+def compact_matrix(result: dict) -> dict:
+    if "error" in result:
+        return {"train_model": result["train_model"], "date": result["date"], "error": result["error"]}
+
+    stations = result["stations"]
+    seat_types = [seat_type for seat_type in result["seat_types"] if result["has_data_map"][seat_type]]
+    cells = {}
+    for seat_type in seat_types:
+        rows = []
+        matrix = result["fare_matrices"][seat_type]
+        fares = result["fares"][seat_type]
+        for i, from_city in enumerate(stations):
+            for j in range(i + 1, len(stations)):
+                cell = matrix[from_city].get(stations[j])
+                if cell and (cell["online"] + cell["offline"] > 0 or cell["status"] in (PAIR_FAILED, PAIR_STALE)):
+                    fare = fares[from_city].get(stations[j])
+                    rows.append([i, j, cell["online"], cell["offline"], sum(fare) if fare else None, cell["status"]])
+        cells[seat_type] = rows
+
+    return {
+        "train_model": result["train_model"],
+        "train_name": result["train_name"],
+        "date": result["date"],
+        "stations": stations,
+        "station_dates": [result["station_dates_formatted"][station] for station in stations],
+        "seat_types": seat_types,
+        "cell_fields": ["from", "to", "online", "offline", "fare", "status"],
+        "cells": cells,
+        "pair_status_counts": result["pair_status_counts"],
+    }
@@ -0,0 +1,62 @@
+import gzip, hashlib, threading, time
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class CachedPage:
+    __slots__ = ('etag', 'gzip_body', 'brotli_body', 'created_at')
+
+    def __init__(self, body):
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        self.brotli_body = None
+        self.created_at = time.time()
+
+    def body_for(self, accept_encodings):
+        # Only the gzip form is kept; brotli is produced on first demand and
+        # identity bodies are inflated for the rare client that needs them.
+        if brotli and accept_encodings['br'] > 0:
+            if self.brotli_body is None:
+                self.brotli_body = brotli.compress(gzip.decompress(self.gzip_body))
+            return self.brotli_body, 'br'
+        if accept_encodings['gzip'] > 0:
+            return self.gzip_body, 'gzip'
+        return gzip.decompress(self.gzip_body), None
+
+class RenderedPageCache:
+    def __init__(self, max_entries=200, ttl=1800):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page and time.time() - page.created_at > self.ttl:
+                del self.pages[key]
+                page = None
+            if page:
+                self.pages.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return page
+
+    def put(self, key, html):
+        page = CachedPage(html.encode('utf-8'))
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last=False)
+        return page
+
+    def get_stats(self):
+        with self.lock:
+            return {"entries": len(self.pages), "hits": self.hits, "misses": self.misses}
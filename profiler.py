@@ -0,0 +1,61 @@
+import os, sys, threading, time
+from collections import Counter
+
+class SamplingProfiler:
+    # Periodically snapshots the stacks of the selected threads and keeps
+    # counts in collapsed-stack form ("root;caller;callee count"), which
+    # flamegraph.pl and speedscope read directly.
+    def __init__(self, thread_selector, interval=0.01, max_depth=64):
+        self.thread_selector = thread_selector
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        while self.running:
+            self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        collapsed = []
+        for label, ident in self.thread_selector():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                collapsed.append(";".join([label] + stack[::-1]))
+        with self.lock:
+            self.samples += 1
+            self.stacks.update(collapsed)
+
+    def dump(self):
+        with self.lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def get_stats(self):
+        with self.lock:
+            return {"running": self.running, "samples": self.samples, "distinct_stacks": len(self.stacks)}
@@ -1,28 +1,41 @@
-import threading, time, uuid, queue, random
+import threading, time, uuid
 from typing import Dict, Any, Optional, Callable
 from datetime import datetime, timedelta
-from collections import deque, OrderedDict
+from collections import deque
+from scheduler import QueueEntry, create_policy
+from request_store import ShardedRequestStore, RequestRecord, QUEUED, PROCESSING, COMPLETED, FAILED
+from expiry import DeadlineQueue
+import tracing
+
+HEARTBEAT_DEADLINE = "heartbeat"
+RESULT_DEADLINE = "result"
 
 class RequestQueue:
-    def __init__(self, max_concurrent=1, cooldown_period=3, batch_cleanup_threshold=10, cleanup_interval=30, heartbeat_timeout=60):
-        self.queue = queue.Queue()
-        self.results = {}
-        self.statuses = {}
+    def __init__(self, max_concurrent=1, cooldown_period=3, batch_cleanup_threshold=10, cleanup_interval=30, heartbeat_timeout=60, scheduling_policy=None, congestion_controller=None, state_shards=16, result_ttl=1800):
+        self.scheduler = scheduling_policy or create_policy()
+        self.congestion_controller = congestion_controller
+        self.store = ShardedRequestStore(state_shards)
         self.max_concurrent = max_concurrent
         self.cooldown_period = cooldown_period
         self.active_requests = 0
         self.lock = threading.Lock()
         self.last_request_time = None
         
-        self.queue_order = OrderedDict()
         self.cancelled_requests = set()
+        self.current_entry = None
+        self.current_started_at = None
+        self._schedule_version = -1
+        self._schedule_snapshot = {}
+        self._schedule_built_at = 0.0
+        self._schedule_total_work = 0.0
+        self.schedule_max_age = 1.0
         
-        self.requests = {}
         self.processing_history = deque(maxlen=50)
         self.abandonment_history = deque(maxlen=100)
         self.avg_processing_time = 8.0
         self.cleanup_interval = cleanup_interval
-        self.last_cleanup = time.time()
+        self.expiry = DeadlineQueue()
+        self.result_ttl = result_ttl
         self.batch_cleanup_threshold = batch_cleanup_threshold
         self.heartbeat_timeout = heartbeat_timeout
         
@@ -34,54 +47,85 @@ class RequestQueue:
         self.enhanced_cleanup_thread.daemon = True
         self.enhanced_cleanup_thread.start()
     
-    def add_request(self, request_func, params):
+    def add_request(self, request_func, params, client_id=None, station_count=None, trace_id=None):
         request_id = str(uuid.uuid4())
-        current_time = datetime.now()
+        self.store.add(RequestRecord(request_id))
+        self.expiry.schedule(time.time() + self.heartbeat_timeout, HEARTBEAT_DEADLINE, request_id)
         
         with self.lock:
-            self.queue.put((request_id, request_func, params))
-            queue_size = self.queue.qsize()
-            
-            self.queue_order[request_id] = current_time
-            
-            self.requests[request_id] = {
-                'request_func': request_func,
-                'params': params,
-                'timestamp': time.time(),
-                'last_heartbeat': time.time()
-            }
-            
-            self.statuses[request_id] = {
-                "status": "queued",
-                "position": queue_size,
-                "created_at": current_time,
-                "estimated_time": self._enhanced_estimate_wait_time(queue_size),
-                "last_heartbeat": time.time()
-            }
+            self.scheduler.push(QueueEntry(request_id, request_func, params, client_id, station_count, trace_id))
+        
+        position, estimated_time = self._enhanced_estimate_wait_time(request_id)
+        self.store.update_estimate(request_id, position, estimated_time)
         return request_id
     
-    def _enhanced_estimate_wait_time(self, position):
-        base_time = self.avg_processing_time + (self.cooldown_period / self.max_concurrent)
+    def _build_schedule_snapshot(self):
+        # Walk the queue in the order the policy will actually serve it and
+        # record, for each entry, its position and the expected work ahead of
+        # it including its own run. Rebuilt at most once per schedule_max_age
+        # while the queue keeps changing, and read without the scheduling lock.
+        if (self._schedule_version == self.scheduler.version
+                or time.time() - self._schedule_built_at < self.schedule_max_age):
+            return self._schedule_snapshot
         
-        predicted_abandonments = self._predict_abandonments(position)
-        effective_position = max(1, position - predicted_abandonments)
+        with self.lock:
+            return self._rebuild_schedule_snapshot()
+    
+    def _rebuild_schedule_snapshot(self):
+        if (self._schedule_version == self.scheduler.version
+                or time.time() - self._schedule_built_at < self.schedule_max_age):
+            return self._schedule_snapshot
         
-        batch = (effective_position // self.max_concurrent)
-        position_in_batch = effective_position % self.max_concurrent
+        snapshot = {}
+        cooldown_period = self._current_cooldown()
+        work_ahead = 0.0
+        batch_cost = 0.0
+        for index, entry in enumerate(self.scheduler.ordered()):
+            if index and index % self.max_concurrent == 0:
+                work_ahead += max(0.0, cooldown_period - batch_cost)
+                batch_cost = 0.0
+            batch_cost += entry.expected_cost
+            work_ahead += entry.expected_cost
+            snapshot[entry.request_id] = (index + 1, work_ahead)
         
-        if position_in_batch == 0:
-            position_in_batch = self.max_concurrent
-            batch -= 1
-            
-        wait_time = (batch * self.cooldown_period) + (position_in_batch * base_time)
-        return max(1, int(wait_time))
+        self._schedule_snapshot = snapshot
+        self._schedule_total_work = work_ahead
+        self._schedule_built_at = time.time()
+        self._schedule_version = self.scheduler.version
+        return snapshot
+    
+    def _enhanced_estimate_wait_time(self, request_id):
+        snapshot = self._build_schedule_snapshot()
+        if request_id in snapshot:
+            position, work_ahead = snapshot[request_id]
+        elif request_id in self.store:
+            # Arrived since the last rebuild: assume it goes to the back.
+            position = max(1, len(self.scheduler))
+            work_ahead = self._schedule_total_work + self.avg_processing_time
+        else:
+            return 0, 0
+        
+        current_entry, current_started_at = self.current_entry, self.current_started_at
+        last_request_time = self.last_request_time
+        if current_entry is not None and current_started_at is not None:
+            elapsed = time.time() - current_started_at
+            work_ahead += max(0.0, current_entry.expected_cost - elapsed)
+        elif last_request_time:
+            since_last = (datetime.now() - last_request_time).total_seconds()
+            work_ahead += max(0.0, self._current_cooldown() - since_last)
+        
+        predicted_abandonments = self._predict_abandonments(position)
+        if predicted_abandonments:
+            work_ahead *= 1 - (predicted_abandonments / position)
+        
+        return position, max(1, int(work_ahead))
     
     def _predict_abandonments(self, current_position):
         if not self.abandonment_history or current_position <= 1:
             return 0
         
         recent_time = time.time() - 1800
-        recent_abandonments = [a for a in self.abandonment_history if a['timestamp'] > recent_time]
+        recent_abandonments = [a for a in list(self.abandonment_history) if a['timestamp'] > recent_time]
         
         if len(recent_abandonments) < 5:
             return 0
@@ -90,105 +134,53 @@ class RequestQueue:
         return int(current_position * abandonment_rate * 0.5)
     
     def update_heartbeat(self, request_id):
-        with self.lock:
-            current_time = time.time()
-            if request_id in self.statuses:
-                self.statuses[request_id]["last_heartbeat"] = current_time
-            if request_id in self.requests:
-                self.requests[request_id]["last_heartbeat"] = current_time
-                return True
-        return False
+        return self.store.touch(request_id)
     
     def get_request_status(self, request_id):
-        with self.lock:
-            if request_id in self.statuses:
-                status_data = self.statuses[request_id].copy()
-                
-                if status_data["status"] == "queued":
-                    position = self._get_fast_position(request_id)
-                    status_data["position"] = position
-                    status_data["estimated_time"] = self._enhanced_estimate_wait_time(position)
-                elif status_data["status"] == "processing":
-                    status_data["position"] = 0
-                    status_data["estimated_time"] = 0
-                return status_data
+        status_data = self.store.get_status(request_id)
+        if not status_data:
             return None
-    
-    def _get_fast_position(self, request_id):
-        if request_id not in self.queue_order:
-            return 0
         
-        position = 1
-        target_time = self.queue_order[request_id]
-        
-        for rid, timestamp in self.queue_order.items():
-            if timestamp < target_time and rid not in self.cancelled_requests:
-                position += 1
-            elif rid == request_id:
-                break
-        
-        return position
+        if status_data["status"] == QUEUED:
+            position, estimated_time = self._enhanced_estimate_wait_time(request_id)
+            status_data["position"] = position
+            status_data["estimated_time"] = estimated_time
+        elif status_data["status"] == PROCESSING:
+            status_data["position"] = 0
+            status_data["estimated_time"] = 0
+        return status_data
     
     def get_request_result(self, request_id):
-        with self.lock:
-            if request_id in self.results:
-                result = self.results[request_id]
-                del self.results[request_id]
-                del self.statuses[request_id]
-                return result
-            return None
+        return self.store.pop_result(request_id)
     
     def cancel_request(self, request_id):
+        record = self.store.pop(request_id)
+        
+        if record and record.status == QUEUED:
+            self.abandonment_history.append({
+                'position': record.position,
+                'wait_time': time.time() - record.created_at.timestamp(),
+                'timestamp': time.time()
+            })
+        
         with self.lock:
-            removed = False
-            
-            if request_id in self.statuses:
+            if record:
                 self.cancelled_requests.add(request_id)
-                status = self.statuses[request_id]
-                
-                if status["status"] == "queued":
-                    abandonment_data = {
-                        'position': status.get("position", 0),
-                        'wait_time': time.time() - status["created_at"].timestamp(),
-                        'timestamp': time.time()
-                    }
-                    self.abandonment_history.append(abandonment_data)
-                
-                del self.statuses[request_id]
-                removed = True
-            
-            if request_id in self.results:
-                del self.results[request_id]
-            
-            if request_id in self.requests:
-                del self.requests[request_id]
-            
-            if request_id in self.queue_order:
-                del self.queue_order[request_id]
+            self.scheduler.remove(request_id)
             
             if len(self.cancelled_requests) >= self.batch_cleanup_threshold:
                 self._batch_remove_cancelled()
-            
-            return removed
+        
+        return record is not None
     
     def _batch_remove_cancelled(self):
         if not self.cancelled_requests:
             return
         
-        temp_queue = queue.Queue()
-        removed_count = 0
-        
-        while not self.queue.empty():
-            try:
-                item = self.queue.get_nowait()
-                if item[0] not in self.cancelled_requests:
-                    temp_queue.put(item)
-                else:
-                    removed_count += 1
-            except queue.Empty:
-                break
+        for request_id in self.cancelled_requests:
+            self.scheduler.remove(request_id)
         
-        self.queue = temp_queue
+        removed_count = self.scheduler.compact()
         self.cancelled_requests.clear()
         
         if removed_count > 0:
@@ -197,61 +189,49 @@ class RequestQueue:
     def _process_queue(self):
         while True:
             batch = []
+            cooldown_period = self._current_cooldown()
+            if self.last_request_time and (datetime.now() - self.last_request_time) < timedelta(seconds=cooldown_period):
+                time_to_wait = (self.last_request_time + timedelta(seconds=cooldown_period) - datetime.now()).total_seconds()
+                if time_to_wait > 0:
+                    time.sleep(time_to_wait)
+            
             with self.lock:
                 if self.cancelled_requests:
                     self._batch_remove_cancelled()
                 
-                if self.last_request_time and (datetime.now() - self.last_request_time) < timedelta(seconds=self.cooldown_period):
-                    time_to_wait = (self.last_request_time + timedelta(seconds=self.cooldown_period) - datetime.now()).total_seconds()
-                    if time_to_wait > 0:
-                        self.lock.release()
-                        time.sleep(time_to_wait)
-                        self.lock.acquire()
-                
-                while len(batch) < self.max_concurrent and not self.queue.empty():
-                    item = self.queue.get()
-                    request_id = item[0]
+                while len(batch) < self.max_concurrent:
+                    entry = self.scheduler.pop()
+                    if entry is None:
+                        break
+                    request_id = entry.request_id
                     
                     if request_id in self.cancelled_requests:
                         self.cancelled_requests.discard(request_id)
                         continue
                     
-                    if request_id in self.statuses:
-                        batch.append(item)
-                        self.statuses[request_id]["status"] = "processing"
-                        self.queue_order.pop(request_id, None)
+                    if self.store.transition(request_id, PROCESSING, from_status=QUEUED):
+                        batch.append(entry)
                 
                 if batch:
                     self.last_request_time = datetime.now()
             
-            for request_id, request_func, params in batch:
+            for entry in batch:
+                request_id, request_func, params = entry.request_id, entry.request_func, entry.params
                 start_time = time.time()
+                finished = False
                 
-                with self.lock:
-                    if request_id not in self.statuses:
-                        continue
+                if request_id not in self.store:
+                    continue
+                self.current_started_at = start_time
+                self.current_entry = entry
                 
                 try:
-                    max_retries = 3
-                    retry_count = 0
-                    retry_delay = 5
-                    
-                    while retry_count < max_retries:
-                        with self.lock:
-                            if request_id not in self.statuses:
-                                break
-                        
-                        try:
+                    trace = tracing.trace_store.get(entry.trace_id)
+                    with tracing.activate(trace):
+                        if trace:
+                            tracing.record_span("queue_wait", trace.started_at, start_time)
+                        with tracing.span("process", request_id=request_id):
                             result = request_func(**params)
-                            break
-                        except Exception as e:
-                            if "Rate limit exceeded" in str(e) or "403" in str(e):
-                                retry_count += 1
-                                if retry_count < max_retries:
-                                    retry_delay_with_jitter = retry_delay + (retry_count * 2) + (random.random() * 2)
-                                    time.sleep(retry_delay_with_jitter)
-                                    continue
-                            raise
                     
                     end_time = time.time()
                     processing_time = end_time - start_time
@@ -261,84 +241,88 @@ class RequestQueue:
                         self.avg_processing_time = sum(self.processing_history) / len(self.processing_history)
                     
                     with self.lock:
-                        if request_id in self.statuses:
-                            self.results[request_id] = result
-                            self.statuses[request_id]["status"] = "completed"
+                        self.scheduler.record_completion(entry, processing_time, self.avg_processing_time)
+                    finished = self.store.transition(request_id, COMPLETED, result=result)
                 except Exception as e:
-                    with self.lock:
-                        if request_id in self.statuses:
-                            self.results[request_id] = {"error": str(e)}
-                            self.statuses[request_id]["status"] = "failed"
+                    finished = self.store.transition(request_id, FAILED, result={"error": str(e)})
+                finally:
+                    self.current_entry = None
+                    self.current_started_at = None
+                
+                if finished:
+                    self.expiry.schedule(time.time() + self.result_ttl, RESULT_DEADLINE, request_id)
             
             if not batch:
                 time.sleep(1)
-                self._cleanup_old_entries()
     
-    def _cleanup_old_entries(self):
-        with self.lock:
-            current_time = datetime.now()
-            expired_ids = []
-            
-            for request_id, status in self.statuses.items():
-                if status["status"] in ["completed", "failed"] and "created_at" in status:
-                    time_diff = current_time - status["created_at"]
-                    if time_diff.total_seconds() > 1800:
-                        expired_ids.append(request_id)
-            
-            for request_id in expired_ids:
-                if request_id in self.results:
-                    del self.results[request_id]
-                if request_id in self.statuses:
-                    del self.statuses[request_id]
-                if request_id in self.queue_order:
-                    del self.queue_order[request_id]
+    def _current_cooldown(self):
+        if self.congestion_controller:
+            return self.congestion_controller.pacing_delay(self.cooldown_period)
+        return self.cooldown_period
     
     def _enhanced_cleanup_loop(self):
         while True:
-            time.sleep(self.cleanup_interval)
+            next_deadline = self.expiry.next_deadline()
+            wait = self.cleanup_interval
+            if next_deadline is not None:
+                wait = min(wait, max(1, next_deadline - time.time()))
+            time.sleep(wait)
             self._enhanced_cleanup()
             with self.lock:
                 if self.cancelled_requests:
                     self._batch_remove_cancelled()
     
     def _enhanced_cleanup(self):
-        current_time = time.time()
-        stale_requests = []
+        # Only deadlines that have passed are visited. A heartbeat deadline
+        # for a request that has heartbeated since is pushed back to its new
+        # deadline rather than updated on every heartbeat.
+        now = time.time()
+        stale_requests = 0
         
-        with self.lock:
-            for request_id, status in self.statuses.items():
-                if status["status"] == "queued":
-                    last_heartbeat = status.get("last_heartbeat", 0)
-                    if current_time - last_heartbeat > self.heartbeat_timeout:
-                        stale_requests.append(request_id)
-        
-        for request_id in stale_requests:
-            self.cancel_request(request_id)
+        for kind, request_id in self.expiry.pop_due(now):
+            status = self.store.get_status(request_id)
+            if not status:
+                continue
+            
+            if kind == HEARTBEAT_DEADLINE:
+                if status["status"] != QUEUED:
+                    continue
+                deadline = status["last_heartbeat"] + self.heartbeat_timeout
+                if deadline > now:
+                    self.expiry.reschedule(deadline, kind, request_id)
+                    continue
+                self.cancel_request(request_id)
+                self.expiry.record_expired(kind)
+                stale_requests += 1
+            elif kind == RESULT_DEADLINE:
+                if status["status"] in (COMPLETED, FAILED) and self.store.pop(request_id):
+                    self.expiry.record_expired(kind)
         
         if stale_requests:
-            print(f"Enhanced cleanup: Removed {len(stale_requests)} stale requests")
+            print(f"Enhanced cleanup: Removed {stale_requests} stale requests")
     
     def force_cleanup(self):
         with self.lock:
             if self.cancelled_requests:
                 self._batch_remove_cancelled()
         self._enhanced_cleanup()
-        self._cleanup_old_entries()
     
     def get_queue_stats(self):
-        with self.lock:
-            total_queued = sum(1 for s in self.statuses.values() if s["status"] == "queued")
-            total_processing = sum(1 for s in self.statuses.values() if s["status"] == "processing")
-            recent_abandonments = len([a for a in self.abandonment_history 
-                                      if time.time() - a['timestamp'] < 3600])
-            
-            return {
-                "queued": total_queued,
-                "processing": total_processing,
-                "avg_processing_time": round(self.avg_processing_time, 2),
-                "recent_abandonments": recent_abandonments,
-                "queue_size": self.queue.qsize(),
-                "cancelled_pending": len(self.cancelled_requests)
-            }
+        counts = self.store.counts()
+        recent_abandonments = len([a for a in list(self.abandonment_history)
+                                  if time.time() - a['timestamp'] < 3600])
+        
+        return {
+            "queued": counts[QUEUED],
+            "processing": counts[PROCESSING],
+            "completed": counts[COMPLETED],
+            "failed": counts[FAILED],
+            "avg_processing_time": round(self.avg_processing_time, 2),
+            "recent_abandonments": recent_abandonments,
+            "queue_size": len(self.scheduler),
+            "cancelled_pending": len(self.cancelled_requests),
+            "expiry": self.expiry.get_stats(),
+            "upstream": self.congestion_controller.get_stats() if self.congestion_controller else None
+        }
 
 request_queue = RequestQueue()
\ No newline at end of file
@@ -0,0 +1,122 @@
+import threading, time
+from datetime import datetime
+
+QUEUED = "queued"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+REQUEST_STATES = (QUEUED, PROCESSING, COMPLETED, FAILED)
+
+class RequestRecord:
+    __slots__ = ('request_id', 'status', 'created_at', 'last_heartbeat', 'position',
+                 'estimated_time', 'result')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.status = QUEUED
+        self.created_at = datetime.now()
+        self.last_heartbeat = time.time()
+        self.position = 0
+        self.estimated_time = 0
+        self.result = None
+
+    def to_status(self):
+        return {
+            "status": self.status,
+            "position": self.position,
+            "created_at": self.created_at,
+            "estimated_time": self.estimated_time,
+            "last_heartbeat": self.last_heartbeat
+        }
+
+class _Shard:
+    __slots__ = ('lock', 'records', 'counts')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.counts = dict.fromkeys(REQUEST_STATES, 0)
+
+class ShardedRequestStore:
+    # Request state split across independently locked shards so heartbeats
+    # and status polls for different requests never wait on each other or
+    # on the worker. Each shard keeps per-state counts up to date on every
+    # transition, so totals cost O(shards) rather than a scan of all records.
+    def __init__(self, shard_count=16):
+        self.shards = [_Shard() for _ in range(shard_count)]
+
+    def _shard(self, request_id):
+        return self.shards[hash(request_id) % len(self.shards)]
+
+    def add(self, record):
+        shard = self._shard(record.request_id)
+        with shard.lock:
+            shard.records[record.request_id] = record
+            shard.counts[record.status] += 1
+
+    def __contains__(self, request_id):
+        return request_id in self._shard(request_id).records
+
+    def get_status(self, request_id):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.get(request_id)
+            return record.to_status() if record else None
+
+    def touch(self, request_id, now=None):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.get(request_id)
+            if not record:
+                return False
+            record.last_heartbeat = now or time.time()
+            return True
+
+    def update_estimate(self, request_id, position, estimated_time):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.get(request_id)
+            if record:
+                record.position = position
+                record.estimated_time = estimated_time
+
+    def transition(self, request_id, new_status, result=None, from_status=None):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.get(request_id)
+            if not record or (from_status and record.status != from_status):
+                return False
+            shard.counts[record.status] -= 1
+            shard.counts[new_status] += 1
+            record.status = new_status
+            if result is not None:
+                record.result = result
+            return True
+
+    def pop(self, request_id):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.pop(request_id, None)
+            if record:
+                shard.counts[record.status] -= 1
+            return record
+
+    def pop_result(self, request_id):
+        shard = self._shard(request_id)
+        with shard.lock:
+            record = shard.records.get(request_id)
+            if not record or record.result is None:
+                return None
+            del shard.records[request_id]
+            shard.counts[record.status] -= 1
+            return record.result
+
+    def counts(self):
+        totals = dict.fromkeys(REQUEST_STATES, 0)
+        for shard in self.shards:
+            for state, count in shard.counts.items():
+                totals[state] += count
+        return totals
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self.shards)
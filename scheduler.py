@@ -0,0 +1,189 @@
+import heapq, itertools, time
+from collections import defaultdict
+
+class QueueEntry:
+    __slots__ = ('request_id', 'request_func', 'params', 'client_id', 'station_count',
+                 'expected_cost', 'enqueued_at', 'sort_key', 'seq', 'removed', 'trace_id')
+
+    def __init__(self, request_id, request_func, params, client_id=None, station_count=None, trace_id=None):
+        self.request_id = request_id
+        self.request_func = request_func
+        self.params = params
+        self.client_id = client_id
+        self.station_count = station_count
+        self.expected_cost = 0.0
+        self.enqueued_at = time.monotonic()
+        self.sort_key = 0.0
+        self.seq = 0
+        self.removed = False
+        self.trace_id = trace_id
+
+    def __lt__(self, other):
+        return (self.sort_key, self.seq) < (other.sort_key, other.seq)
+
+class JobCostEstimator:
+    # Cost of a matrix job grows with the number of station pairs queried,
+    # n * (n - 1) / 2, so learn a per-pair time and a fixed per-job overhead.
+    def __init__(self, default_cost=8.0, default_station_count=12, overhead=2.0, smoothing=0.2):
+        self.default_cost = default_cost
+        self.default_station_count = default_station_count
+        self.overhead = overhead
+        self.smoothing = smoothing
+        pairs = self._pairs(default_station_count)
+        self.per_pair_time = max(0.01, (default_cost - overhead) / pairs)
+
+    @staticmethod
+    def _pairs(station_count):
+        return max(1, station_count * (station_count - 1) // 2)
+
+    def estimate(self, station_count):
+        # Batch jobs pass one station count per train; unknown trains are
+        # assumed to be of typical length.
+        if isinstance(station_count, (list, tuple)):
+            pairs = sum(self._pairs(n or self.default_station_count) for n in station_count)
+            return self.overhead + self.per_pair_time * pairs
+        if not station_count:
+            return self.default_cost
+        return self.overhead + self.per_pair_time * self._pairs(station_count)
+
+    def record(self, station_count, processing_time, avg_processing_time=None):
+        if avg_processing_time is not None:
+            self.default_cost = avg_processing_time
+        if isinstance(station_count, (list, tuple)):
+            return
+        if not station_count or processing_time <= self.overhead:
+            return
+        observed = (processing_time - self.overhead) / self._pairs(station_count)
+        self.per_pair_time += self.smoothing * (observed - self.per_pair_time)
+
+class SchedulingPolicy:
+    def __init__(self, estimator=None):
+        self.estimator = estimator or JobCostEstimator()
+        self.version = 0
+
+    def push(self, entry):
+        raise NotImplementedError
+
+    def pop(self):
+        raise NotImplementedError
+
+    def remove(self, request_id):
+        raise NotImplementedError
+
+    def compact(self):
+        return 0
+
+    def ordered(self):
+        raise NotImplementedError
+
+    def record_completion(self, entry, processing_time, avg_processing_time=None):
+        self.estimator.record(entry.station_count, processing_time, avg_processing_time)
+
+    def __len__(self):
+        raise NotImplementedError
+
+class FifoPolicy(SchedulingPolicy):
+    def __init__(self, estimator=None):
+        super().__init__(estimator)
+        self.entries = {}
+
+    def push(self, entry):
+        entry.expected_cost = self.estimator.estimate(entry.station_count)
+        self.entries[entry.request_id] = entry
+        self.version += 1
+
+    def pop(self):
+        if not self.entries:
+            return None
+        request_id = next(iter(self.entries))
+        self.version += 1
+        return self.entries.pop(request_id)
+
+    def remove(self, request_id):
+        entry = self.entries.pop(request_id, None)
+        if entry:
+            self.version += 1
+        return entry is not None
+
+    def ordered(self):
+        return list(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+class FairShortestJobPolicy(SchedulingPolicy):
+    # Priority is expected cost inflated by the client's number of outstanding
+    # jobs, minus aging_rate seconds for every second spent waiting. The aging
+    # term is identical for all entries at any instant, so it folds into a
+    # static key (cost + aging_rate * enqueued_at) and a plain heap suffices.
+    def __init__(self, estimator=None, aging_rate=0.5, client_penalty=1.0, client_weights=None):
+        super().__init__(estimator)
+        self.aging_rate = aging_rate
+        self.client_penalty = client_penalty
+        self.client_weights = client_weights or {}
+        self.heap = []
+        self.entries = {}
+        self.client_outstanding = defaultdict(int)
+        self.counter = itertools.count()
+
+    def _effective_cost(self, entry):
+        outstanding = self.client_outstanding[entry.client_id] if entry.client_id else 0
+        weight = self.client_weights.get(entry.client_id, 1.0)
+        return entry.expected_cost * (1 + self.client_penalty * outstanding) / weight
+
+    def push(self, entry):
+        entry.expected_cost = self.estimator.estimate(entry.station_count)
+        entry.seq = next(self.counter)
+        entry.sort_key = self._effective_cost(entry) + self.aging_rate * entry.enqueued_at
+        if entry.client_id:
+            self.client_outstanding[entry.client_id] += 1
+        self.entries[entry.request_id] = entry
+        heapq.heappush(self.heap, entry)
+        self.version += 1
+
+    def pop(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry.removed:
+                continue
+            del self.entries[entry.request_id]
+            self._release_client(entry)
+            self.version += 1
+            return entry
+        return None
+
+    def remove(self, request_id):
+        entry = self.entries.pop(request_id, None)
+        if not entry:
+            return False
+        entry.removed = True
+        self._release_client(entry)
+        self.version += 1
+        return True
+
+    def _release_client(self, entry):
+        if not entry.client_id:
+            return
+        self.client_outstanding[entry.client_id] -= 1
+        if self.client_outstanding[entry.client_id] <= 0:
+            del self.client_outstanding[entry.client_id]
+
+    def compact(self):
+        removed_count = len(self.heap) - len(self.entries)
+        if removed_count:
+            self.heap = [e for e in self.heap if not e.removed]
+            heapq.heapify(self.heap)
+        return removed_count
+
+    def ordered(self):
+        return sorted(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+def create_policy(name="fair_sjf", **options):
+    if name == "fifo":
+        return FifoPolicy(estimator=options.get("estimator"))
+    if name == "fair_sjf":
+        return FairShortestJobPolicy(**options)
+    raise ValueError(f"Unknown scheduling policy: {name}")
@@ -0,0 +1,127 @@
+import threading, time, uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'attrs', 'thread')
+
+    def __init__(self, name, start, duration, attrs):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "offset": round(self.start - origin, 4),
+            "duration": round(self.duration, 4),
+            "thread": self.thread,
+            **self.attrs
+        }
+
+class Trace:
+    def __init__(self, trace_id, max_spans=500):
+        self.trace_id = trace_id
+        self.started_at = time.time()
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def summary(self, slowest=10):
+        with self.lock:
+            spans = list(self.spans)
+        phases = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0})
+        for span in spans:
+            phase = phases[span.name]
+            phase["count"] += 1
+            phase["total"] += span.duration
+            phase["max"] = max(phase["max"], span.duration)
+        for phase in phases.values():
+            phase["total"] = round(phase["total"], 4)
+            phase["max"] = round(phase["max"], 4)
+        end = max((span.start + span.duration for span in spans), default=self.started_at)
+        return {
+            "trace_id": self.trace_id,
+            "started_at": self.started_at,
+            "elapsed": round(end - self.started_at, 4),
+            "phases": dict(phases),
+            "slowest": [span.to_dict(self.started_at) for span in sorted(spans, key=lambda s: s.duration, reverse=True)[:slowest]],
+            "spans": [span.to_dict(self.started_at) for span in sorted(spans, key=lambda s: s.start)],
+            "dropped_spans": self.dropped
+        }
+
+class TraceStore:
+    def __init__(self, max_traces=50, max_spans=500):
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        trace = Trace(str(uuid.uuid4()), self.max_spans)
+        with self.lock:
+            self.traces[trace.trace_id] = trace
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        return trace
+
+    def get(self, trace_id):
+        if not trace_id:
+            return None
+        with self.lock:
+            return self.traces.get(trace_id)
+
+trace_store = TraceStore()
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def current_trace_id():
+    trace = current_trace()
+    return trace.trace_id if trace else None
+
+@contextmanager
+def activate(trace):
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+@contextmanager
+def span(name, **attrs):
+    # Yields the attribute dict so callers can annotate the span with
+    # outcomes known only once the work is done.
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        trace = current_trace()
+        if trace:
+            trace.add(Span(name, start, time.time() - start, attrs))
+
+def record_span(name, start, end=None, **attrs):
+    trace = current_trace()
+    if trace:
+        trace.add(Span(name, start, (end or time.time()) - start, attrs))
+
+def propagate(func):
+    # Executor threads do not inherit the submitting thread's trace.
+    trace = current_trace()
+    def wrapper(*args, **kwargs):
+        with activate(trace):
+            return func(*args, **kwargs)
+    return wrapper